@@ -35,16 +35,22 @@ rem Run the program in the environment
 import argparse
 import collections
 import csv
-import itertools
+import functools
+import hashlib
+import io
 import logging
 import mpyq
 import multiprocessing
-import operator
+import multiprocessing.util
 import os
 import pathlib
+import pickle
 import s2protocol
+import s2protocol.decoders
 import s2protocol.versions
+import sqlite3
 import sys
+import time
 import zipfile
 
 __copyright__ = "(c) 2019 TheCoreSC2 Team <https://github.com/thecoresc2/>"
@@ -55,175 +61,413 @@ EVENT_UNIT_INIT_ID = 6
 EVENT_UNIT_BORN_ID = 1
 EVENT_CAMERA_SAVE_ID = 14
 EVENT_CAMERA_UPDATE_ID = 49
-EVENT_PLAYER_SETUP_ID = 9
 
 LATEST = s2protocol.versions.latest()
+# Protocols by base build, with their decoding functions bound. The event
+# decoders take the contents and the ids of the events to decode.
+Protocol = collections.namedtuple('Protocol', ('protocol', 'decode_tracker_events', 'decode_game_events', 'decode_initdata'))
 protocols = {}
-WARP_INS = (
+WARP_INS = frozenset((
   # Gateway warp-ins
   b'Zealot', b'Adept', b'Stalker', b'Sentry', b'DarkTemplar', b'HighTemplar'
-)
+))
 
-EXCLUDED_UNITS = (
+EXCLUDED_UNITS = frozenset((
   b'Larva', b'Broodling', b'BroodlingEscort', b'Archon'
-)
+))
+
+# Decoded unit names, so that each name is decoded and allocated only once.
+unit_names = {}
+
+def read_vint(contents, pos):
+  # Variable length integer of the versioned encoding, returns the value and
+  # the position following it.
+  b = contents[pos]
+  pos += 1
+  negative = b & 1
+  result = (b >> 1) & 0x3f
+  bits = 6
+  while b & 0x80:
+    b = contents[pos]
+    pos += 1
+    result |= (b & 0x7f) << bits
+    bits += 7
+  return (-result if negative else result), pos
+
+def read_base_build(contents):
+  # The header is versioned: each value starts with a byte giving its kind,
+  # structs hold a count of tagged fields. The base build is field 5 of the
+  # version struct, field 1 of the header, after only the signature blob.
+  pos = 0
+  for wanted_tag in (1, 5):
+    if contents[pos] != 5:
+      raise ValueError('Expected a struct at {}'.format(pos))
+    count, pos = read_vint(contents, pos + 1)
+    for _ in range(count):
+      tag, pos = read_vint(contents, pos)
+      if tag == wanted_tag:
+        break
+      # Skip fields preceding the one we want, only blobs and ints are expected.
+      if contents[pos] == 2:
+        length, pos = read_vint(contents, pos + 1)
+        pos += length
+      elif contents[pos] == 9:
+        _, pos = read_vint(contents, pos + 1)
+      else:
+        raise ValueError('Unexpected field kind {} at {}'.format(contents[pos], pos))
+    else:
+      raise ValueError('Missing field {}'.format(wanted_tag))
+  if contents[pos] != 9:
+    raise ValueError('Expected an int at {}'.format(pos))
+  return read_vint(contents, pos + 1)[0]
 
 def get_protocol(replay):
   # Read the protocol header, this can be read with any protocol
   contents = replay.header['user_data_header']['content']
-  header = LATEST.decode_replay_header(contents)
-  version = header['m_version']['m_baseBuild']
+  try:
+    version = read_base_build(contents)
+  except (IndexError, ValueError):
+    header = LATEST.decode_replay_header(contents)
+    version = header['m_version']['m_baseBuild']
   if version not in protocols:
-    protocols[version] = s2protocol.versions.build(version)
+    protocol = s2protocol.versions.build(version)
+    protocols[version] = Protocol(
+      protocol,
+      functools.partial(decode_events, protocol, protocol.tracker_eventid_typeid, protocol.tracker_event_types, False),
+      functools.partial(decode_events, protocol, protocol.game_eventid_typeid, protocol.game_event_types, True),
+      protocol.decode_replay_initdata)
   # Find protocol.
   return protocols[version]
 
-
-def process_replay(replay, processor):
-  return processor.process_replay(mpyq.MPQArchive(replay))
-
-def process_replay_in_pack(pack_and_replay):
-  processor, pack, which_replay = pack_and_replay
-
+def decode_events(protocol, eventid_typeid, event_types, decode_user_id, contents, wanted):
+  # Same as the protocols' event stream decoding, but only the events in
+  # wanted are materialized. Others are skipped, without decoding their
+  # fields when the encoding allows it (tracker events are versioned).
+  if decode_user_id:
+    decoder = s2protocol.decoders.BitPackedDecoder(contents, protocol.typeinfos)
+  else:
+    decoder = s2protocol.decoders.VersionedDecoder(contents, protocol.typeinfos)
+  skip_instance = getattr(decoder, '_skip_instance', None)
+  svaruint32_typeid = protocol.svaruint32_typeid
+  userid = None
+  gameloop = 0
+  while not decoder.done():
+    # Decode the gameloop delta, a choice holding a single value.
+    for delta in decoder.instance(svaruint32_typeid).values():
+      gameloop += delta
+    if decode_user_id:
+      userid = decoder.instance(protocol.replay_userid_typeid)
+    eventid = decoder.instance(eventid_typeid)
+    typeid, typename = event_types.get(eventid, (None, None))
+    if typeid is None:
+      raise s2protocol.decoders.CorruptedError('eventid({}) at {}'.format(eventid, decoder))
+    if eventid in wanted:
+      event = decoder.instance(typeid)
+      event['_event'] = typename
+      event['_eventid'] = eventid
+      event['_gameloop'] = gameloop
+      if decode_user_id:
+        event['_userid'] = userid
+      decoder.byte_align()
+      yield event
+    else:
+      if skip_instance is not None:
+        skip_instance()
+      else:
+        decoder.instance(typeid)
+      decoder.byte_align()
+
+# Bump whenever a processor's output changes, to invalidate cached results.
+SCHEMA_VERSION = 2
+# How much of a replay is hashed to identify it in the cache.
+CACHE_HASH_SIZE = 64 * 1024
+
+def open_cache(path):
+  # Only the main process writes to the cache, workers open it read only.
+  cache = sqlite3.connect(path)
+  cache.execute('PRAGMA journal_mode=WAL')
+  cache.execute('CREATE TABLE IF NOT EXISTS results ('
+                'processor TEXT, hash TEXT, size INTEGER, schema INTEGER, stats BLOB, '
+                'PRIMARY KEY (processor, hash, size, schema))')
+  cache.commit()
+  return cache
+
+def store_cached(cache, key, replay_stats):
+  cache.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)', key + (pickle.dumps(replay_stats),))
+
+# Set once per worker by init_worker, rather than pickled with every task.
+processor_class = None
+cache = None
+
+def init_worker(worker_processor_class, cache_path):
+  global processor_class, cache
+  processor_class = worker_processor_class
+  # Workers exit without running atexit hooks, but run their finalizers when
+  # the pool is closed and joined.
+  multiprocessing.util.Finalize(None, close_packs, exitpriority=0)
+  if cache_path is not None:
+    cache = sqlite3.connect(pathlib.Path(cache_path).resolve().as_uri() + '?mode=ro', uri=True)
+
+def process_replay(contents):
+  # Returns the cache key to store the stats under, or None on a cache hit.
+  key = None
+  if cache is not None:
+    key = (processor_class.__name__, hashlib.sha1(contents[:CACHE_HASH_SIZE]).hexdigest(), len(contents), SCHEMA_VERSION)
+    row = cache.execute('SELECT stats FROM results WHERE processor = ? AND hash = ? AND size = ? AND schema = ?', key).fetchone()
+    if row is not None:
+      return None, pickle.loads(row[0])
+  # Replays are small and MPQ reads seek a lot, parse them from memory.
+  return key, processor_class.process_replay(mpyq.MPQArchive(io.BytesIO(contents)))
+
+# How much of a file to ask the kernel to prefetch.
+READAHEAD_SIZE = 8 << 20
+
+def advise_sequential(f):
+  # Hint the kernel that the file is read front to back, where supported.
+  if hasattr(os, 'posix_fadvise'):
+    try:
+      os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+      os.posix_fadvise(f.fileno(), 0, READAHEAD_SIZE, os.POSIX_FADV_WILLNEED)
+    except OSError:
+      pass
+
+# Packs opened by this worker, keyed by path, least recently used first.
+MAX_OPEN_PACKS = 8
+packs = collections.OrderedDict()
+
+def open_pack(pack):
+  # Keep packs open so their central directory is only parsed once per worker.
+  if pack in packs:
+    packs.move_to_end(pack)
+  else:
+    packs[pack] = zipfile.ZipFile(pack)
+    advise_sequential(packs[pack].fp)
+    if len(packs) > MAX_OPEN_PACKS:
+      packs.popitem(last=False)[1].close()
+  return packs[pack]
+
+def close_packs():
+  while packs:
+    packs.popitem()[1].close()
+
+def process_replay_in_pack(pack, which_replay):
   try:
-    with zipfile.ZipFile(pack) as replay_pack:
-      return process_replay(replay_pack.open(which_replay), processor())
-  except BaseException as e:
-    return {'error': 'Failed to load {} from {}: {}'.format(which_replay, pack, e)}
+    return process_replay(open_pack(pack).read(which_replay))
+  except Exception as e:
+    return None, {'error': 'Failed to load {} from {}: {}'.format(which_replay, pack, e)}
 
 def process_replay_path(replay_path):
-  processor, replay_path = replay_path
   try:
-    return process_replay(str(replay_path), processor())
-  except BaseException as e:
-    return {'error': '{}: {}'.format(str(replay_path), e)}
-
-def count_replays(paths):
-  replays_count = 0
+    with open(replay_path, 'rb') as replay:
+      advise_sequential(replay)
+      contents = replay.read()
+    return process_replay(contents)
+  except Exception as e:
+    return None, {'error': '{}: {}'.format(str(replay_path), e)}
+
+def process_task(task):
+  # Tasks are tagged tuples, see all_tasks.
+  if task[0] == 'pack':
+    return process_replay_in_pack(task[1], task[2])
+  return process_replay_path(task[1])
+
+# Most replays processed by a worker in one go.
+MAX_BATCH_SIZE = 32
+
+def process_batch(batch):
+  # Aggregate a batch of tasks in the worker, to send back a single result:
+  # the number of replays, the aggregated stats, errors, and the stats of
+  # each replay to store in the cache.
+  processor = processor_class()
+  errors = []
+  to_cache = []
+  for task in batch:
+    cache_key, replay_stats = process_task(task)
+    if 'error' in replay_stats:
+      errors.append(replay_stats['error'])
+    else:
+      processor.aggregate(replay_stats)
+      if cache_key is not None:
+        to_cache.append((cache_key, replay_stats))
+  return len(batch), processor.aggregated, errors, to_cache
+
+def preload_protocol(task):
+  # Build the protocol of a task's replay in this process. Done in the parent
+  # before forking, the workers share it instead of each building their own.
+  try:
+    if task[0] == 'pack':
+      with zipfile.ZipFile(task[1]) as pack:
+        contents = pack.read(task[2])
+    else:
+      with open(task[1], 'rb') as replay:
+        contents = replay.read()
+    get_protocol(mpyq.MPQArchive(io.BytesIO(contents), listfile=False))
+  except Exception as e:
+    # Only an optimization, the worker reports the replay's errors.
+    logging.debug('Failed to preload protocol for %s: %s', ' '.join(task[1:]), e)
+
+def walk(root):
+  # Recursively list packs and standalone replays in a single pass.
+  try:
+    entries = list(os.scandir(root))
+  except OSError as e:
+    logging.warning('Failed to list %s: %s', root, e)
+    return
+  for entry in entries:
+    if entry.is_dir(follow_symlinks=False):
+      yield from walk(entry.path)
+      continue
+    # Match suffixes like glob did, case insensitively on Windows.
+    name = os.path.normcase(entry.name)
+    if name.endswith(os.path.normcase('.zip')):
+      yield ('zip', entry.path)
+    elif name.endswith(os.path.normcase('.SC2Replay')):
+      yield ('replay', entry.path)
+
+def all_tasks(paths):
   for path in paths:
-    # Count files in replay packs.
-    for replay_pack in path.glob('**/*.zip'):
+    logging.info('Listing replays in %s', path)
+    for kind, file_path in walk(path):
+      if kind == 'replay':
+        yield ('path', file_path)
+        continue
+      logging.info('Listing pack %s', file_path)
       try:
-        with zipfile.ZipFile(replay_pack) as pack:
-          replays_count += sum(1 for _ in (replay for replay in pack.namelist() if replay.endswith('.SC2Replay')))
-      except:
-        logging.warning('Failed to open %s. Skipped', replay_pack)
-    # Count individual replays
-    replays_count += sum(1 for _ in path.glob('**/*.SC2Replay'))
-  return replays_count
+        with zipfile.ZipFile(file_path) as pack:
+          replays = [replay for replay in pack.namelist() if replay.endswith('.SC2Replay')]
+      except Exception:
+        logging.warning('Failed to open %s. Skipped', file_path)
+        continue
+      for replay in replays:
+        yield ('pack', file_path, replay)
 
 class BuildProcessor(object):
   def __init__(self):
     self.aggregated = {
-      'units': collections.Counter(),
-      'buildings': collections.Counter(),
-      'abilities': collections.Counter()
+      'units': {},
+      'buildings': {},
+      'abilities': {}
     }
   def aggregate(self, replay_stats):
-    for k, v in replay_stats.items():
-      self.aggregated[k].update(v)
+    for kind, counts in replay_stats.items():
+      aggregated = self.aggregated[kind]
+      for name, count in counts.items():
+        aggregated[name] = aggregated.get(name, 0) + count
 
   @classmethod
   def process_replay(cls, replay):
-    stats = {
-      'units': collections.Counter(),
-      'buildings': collections.Counter(),
-      'abilities': collections.Counter()
-    }
+    units = {}
+    buildings = {}
+    abilities = {}
+    # Bind everything used per event locally, this loop runs for every tracker event.
+    init_id = EVENT_UNIT_INIT_ID
+    excluded = EXCLUDED_UNITS
+    warpins = WARP_INS
+    names = unit_names
 
-    tracker_events = get_protocol(replay).decode_replay_tracker_events(replay.read_file('replay.tracker.events'))
     # Only born or init events.
-    filtered_events = (event for event in tracker_events if event['_eventid'] in (EVENT_UNIT_INIT_ID, EVENT_UNIT_BORN_ID))
-    # Only player events.
-    filtered_events = (event for event in filtered_events if event['m_controlPlayerId'] > 0 and event['_gameloop'] > 0)
-    # Only units of interest.
-    filtered_events = (event for event in filtered_events if event['m_unitTypeName'] not in EXCLUDED_UNITS)
-
-    for event in filtered_events:
-      unit_name = event['m_unitTypeName']
+    _, decode_tracker_events, _, _ = get_protocol(replay)
+    tracker_events = decode_tracker_events(replay.read_file('replay.tracker.events'), (EVENT_UNIT_INIT_ID, EVENT_UNIT_BORN_ID))
+    for event in tracker_events:
       eventid = event['_eventid']
-      destination = 'units' # By default, assume units.
-      creator_ability = None
-      if 'm_creatorAbilityName' in event and event['m_creatorAbilityName'] is not None:
-        creator_ability = event['m_creatorAbilityName']
+      # Only player events.
+      if event['m_controlPlayerId'] <= 0 or event['_gameloop'] <= 0:
+        continue
+      # Only units of interest.
+      unit_name = event['m_unitTypeName']
+      if unit_name in excluded:
+        continue
+
+      destination = units # By default, assume units.
+      creator_ability = event.get('m_creatorAbilityName')
       if creator_ability is not None:
         if b'Train' not in creator_ability:
-          destination = 'abilities'
-          unit_name = b'_'.join([creator_ability, unit_name])  
-      elif eventid == EVENT_UNIT_INIT_ID and unit_name not in WARP_INS:
-        destination = 'buildings'
+          destination = abilities
+          unit_name = b'_'.join([creator_ability, unit_name])
+      elif eventid == init_id and unit_name not in warpins:
+        destination = buildings
         if b'TechLab' in unit_name:
           unit_name = b'TechLab'
         elif b'Reactor' in unit_name:
           unit_name = b'Reactor'
-      stats[destination][unit_name.decode('utf-8')] += 1
-    return stats
+      name = names.get(unit_name)
+      if name is None:
+        name = names[unit_name] = unit_name.decode('utf-8')
+      destination[name] = destination.get(name, 0) + 1
+    return {'units': units, 'buildings': buildings, 'abilities': abilities}
 
   def write_csv(self, writer):
     writer.writerow(['Type', 'Name', 'Usage Count'])
-    for (stuff, count) in self.aggregated['units'].items():
-      writer.writerow(['Unit', stuff, count])
-    for (stuff, count) in self.aggregated['buildings'].items():
-      writer.writerow(['Building', stuff, count])
-    for (stuff, count) in self.aggregated['abilities'].items():
-      writer.writerow(['Ability', stuff, count])
+    # Most used first, then by name, so that the output is deterministic.
+    for kind, label in (('units', 'Unit'), ('buildings', 'Building'), ('abilities', 'Ability')):
+      counts = sorted(self.aggregated[kind].items(), key=lambda item: (-item[1], item[0]))
+      writer.writerows([(label, stuff, count) for stuff, count in counts])
 
 class CameraProcessor(object):
   def __init__(self):
-    self.cameras = {
+    self.aggregated = {
       'saves': [0] * 8,
       'jumps': [0] * 8
     }
   def aggregate(self, stats):
     for i, (saves, jumps) in enumerate(zip(stats['saves'], stats['jumps'])):
-      self.cameras['saves'][i] += saves
-      self.cameras['jumps'][i] += jumps
+      self.aggregated['saves'][i] += saves
+      self.aggregated['jumps'][i] += jumps
 
   @classmethod
-  def get_playerids(cls, protocol, replay):
-    # Details contains the player list with their working ids.
-    events = protocol.decode_replay_tracker_events(replay.read_file('replay.tracker.events'))
-    # Only player setup events.
-    events = (event for event in events if event['_eventid'] == EVENT_PLAYER_SETUP_ID)
-    return set((entry['m_userId'] for entry in events))
+  def get_playerids(cls, decode_initdata, replay):
+    # Init data contains the lobby slots with their working ids, and is much
+    # smaller than the tracker events.
+    initdata = decode_initdata(replay.read_file('replay.initData'))
+    slots = initdata['m_syncLobbyState']['m_lobbyState']['m_slots']
+    # Only human players, observers do not play.
+    return set((slot['m_userId'] for slot in slots if slot['m_userId'] is not None and slot['m_observe'] == 0))
 
   @classmethod
   def process_replay(cls, replay):
     # We need to find the players' user ids, which may change from game to game.
-    protocol = get_protocol(replay)
-    userids = cls.get_playerids(protocol, replay)
+    _, _, decode_game_events, decode_initdata = get_protocol(replay)
+    userids = cls.get_playerids(decode_initdata, replay)
     saved_targets = dict(((userid, [None] * 8) for userid in userids))
-    saved_cameras = dict(((userid, [0] * 8) for userid in userids))
-    jumps = dict(((userid, [0] * 8) for userid in userids))
-    events = get_protocol(replay).decode_replay_game_events(replay.read_file('replay.game.events'))
+    # Reverse mapping of saved_targets, from target to the lowest camera slot
+    # holding it.
+    saved_slots = dict(((userid, {}) for userid in userids))
+    # Counted by camera for all players together.
+    saves = [0] * 8
+    jumps = [0] * 8
     # Only camera events from players.
-    events = (event for event in events if event['_userid']['m_userId'] in userids and event['_eventid'] in (EVENT_CAMERA_SAVE_ID, EVENT_CAMERA_UPDATE_ID))
+    events = decode_game_events(replay.read_file('replay.game.events'), (EVENT_CAMERA_SAVE_ID, EVENT_CAMERA_UPDATE_ID))
+    events = (event for event in events if event['_userid']['m_userId'] in userids)
 
     for event in events:
       eventid = event['_eventid']
       player = event['_userid']['m_userId']
       if eventid == EVENT_CAMERA_SAVE_ID:
         which = event['m_which']
+        # Targets are decoded as dicts, use a hashable key.
+        target = (event['m_target']['x'], event['m_target']['y'])
         # Update the target if necessary
         old_target = saved_targets[player][which]
-        if old_target != event['m_target']:
+        if old_target != target:
           # Debounce
-          saved_targets[player][which] = event['m_target']
-          saved_cameras[player][which] += 1
+          saved_targets[player][which] = target
+          # Saves are rare, rebuild the mapping so that a target saved in
+          # several slots keeps resolving to the lowest one.
+          saved_slots[player] = dict(((slot_target, slot) for slot, slot_target in reversed(list(enumerate(saved_targets[player]))) if slot_target is not None))
+          saves[which] += 1
       elif eventid == EVENT_CAMERA_UPDATE_ID:
-        if 'm_target' in event:
-          target = event['m_target']
-          if target in saved_targets[player]:
+        if event.get('m_target') is not None:
+          which = saved_slots[player].get((event['m_target']['x'], event['m_target']['y']))
+          if which is not None:
             # Update jump counter.
-            jumps[player][saved_targets[player].index(target)] += 1
+            jumps[which] += 1
 
-    # Merge data sets by cameras
-    return {'saves': list(map(operator.add, *saved_cameras.values())), 'jumps': list(map(operator.add, *jumps.values()))}
+    return {'saves': saves, 'jumps': jumps}
 
   def write_csv(self, writer):
     writer.writerow(['Which', 'Saves', 'Jumps'])
     # Write to file.
-    for which, (save_count, jump_count) in enumerate(zip(self.cameras['saves'], self.cameras['jumps'])):
+    for which, (save_count, jump_count) in enumerate(zip(self.aggregated['saves'], self.aggregated['jumps'])):
       writer.writerow([which, save_count, jump_count])
 
 if __name__ == "__main__":
@@ -232,6 +476,7 @@ if __name__ == "__main__":
   common_parser.add_argument('--output', dest='output', type=str, default='replays.csv', help='Output file (default: replays.csv).')
   common_parser.add_argument('--log', dest='log', type=argparse.FileType('w'), default='replays.log', help='Log file (default: replays.log).')
   common_parser.add_argument('--verbose', dest='verbosity', type=int, default=logging.INFO, help='Log level.')
+  common_parser.add_argument('--cache', dest='cache', type=str, default=None, help='Cache results in this SQLite file, to skip replays already processed on later runs.')
   common_parser.add_argument('paths', metavar='DIR', type=pathlib.Path, nargs='+', help='Replays folder(s).')
   common_parser.add_argument('--cpus', type=int, default=multiprocessing.cpu_count(), help='Set concurrency (defaults to {})'.format(multiprocessing.cpu_count()))
 
@@ -246,41 +491,55 @@ if __name__ == "__main__":
   args = parser.parse_args()
   logging.basicConfig(stream=args.log, level=args.verbosity)
   logging.info('Looking for replays in: %s', ' '.join((str(path) for path in args.paths)))
-  replays_count = count_replays(args.paths)
+  # Listing the tasks up front is cheap (paths and names), and gives the total.
+  tasks = list(all_tasks(args.paths))
+  replays_count = len(tasks)
   logging.info('Processing %d replays', replays_count)
 
   with open(args.output, 'w', newline='') as csvoutput:
     processed = 0
+    last_print = 0.0
     processor = args.processor_class()
-    with multiprocessing.Pool(args.cpus) as pool:
-      for path in args.paths:
-        logging.info('Processing replays in %s', path)
-        # First, run through archives.
-        for replay_pack in path.glob('**/*.zip'):
-          logging.info('Processing pack %s', replay_pack)
-          try:
-            with zipfile.ZipFile(replay_pack) as pack:
-              replays = (replay for replay in pack.namelist() if replay.endswith('.SC2Replay'))
-              for replay_stats in pool.imap_unordered(process_replay_in_pack, zip(itertools.repeat(args.processor_class), itertools.repeat(replay_pack), (replay for replay in pack.namelist() if replay.endswith('.SC2Replay')))):
-                processed += 1
-                sys.stdout.write('\b\b\b\b{: >4.0%}'.format(processed / replays_count))
-                sys.stdout.flush()
-                if 'error' in replay_stats:
-                  logging.warning(replay_stats['error'])
-                else:
-                  processor.aggregate(replay_stats)
-          except:
-            logging.warning('Failed to open %s. Skipped', replay_pack)
-            raise
-        # Then run through standalone replays.
-        logging.info('Processing standalone replays')
-        for replay_stats in pool.imap_unordered(process_replay_path, zip(itertools.repeat(args.processor_class), path.glob('**/*.SC2Replay'))):
-          processed += 1
+    # Hand out several replays per task to amortize the IPC overhead, while
+    # keeping enough batches to go around the workers.
+    batch_size = max(1, min(MAX_BATCH_SIZE, replays_count // (args.cpus * 8)))
+    batches = [tasks[i:i + batch_size] for i in range(0, replays_count, batch_size)]
+    if args.cache is not None:
+      # Create the cache for the workers to open, the connection writing to it
+      # is only opened once they are forked.
+      open_cache(args.cache).close()
+    if sys.platform.startswith('linux'):
+      # Replays of a batch mostly share a build, load its protocol once for
+      # all forked workers. Elsewhere, workers load protocols lazily.
+      if tasks:
+        preload_protocol(tasks[0])
+      context = multiprocessing.get_context('fork')
+    else:
+      context = multiprocessing.get_context()
+    with context.Pool(args.cpus, initializer=init_worker, initargs=(args.processor_class, args.cache)) as pool:
+      results_cache = sqlite3.connect(args.cache) if args.cache is not None else None
+      for batch_count, batch_stats, errors, to_cache in pool.imap_unordered(process_batch, batches):
+        processed += batch_count
+        # Refresh the progress at most 10 times per second, and at the end.
+        now = time.monotonic()
+        if now - last_print > 0.1 or processed == replays_count:
+          last_print = now
           sys.stdout.write('\b\b\b\b{: >4.0%}'.format(processed / replays_count))
-          if 'error' in replay_stats:
-            logging.warning(replay_stats['error'])
-          else:
-            processor.aggregate(replay_stats)
+          sys.stdout.flush()
+        for error in errors:
+          logging.warning(error)
+        processor.aggregate(batch_stats)
+        for cache_key, replay_stats in to_cache:
+          store_cached(results_cache, cache_key, replay_stats)
+        if to_cache:
+          # Commit every batch, so that an interrupted run keeps its results.
+          results_cache.commit()
+      # Let the workers exit on their own, running their finalizers, rather
+      # than being terminated.
+      pool.close()
+      pool.join()
+    if results_cache is not None:
+      results_cache.close()
     writer = csv.writer(csvoutput)
     processor.write_csv(writer)
 